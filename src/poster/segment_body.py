@@ -0,0 +1,90 @@
+import os
+import time
+import uuid
+
+
+class SegmentChangedError(Exception):
+    """The segment's size changed between building the body and streaming it."""
+
+
+class MultipartSegmentBody:
+    """A multipart/form-data upload body that streams the segment from disk.
+
+    `requests` reads `files=` entries fully into memory to build the body;
+    this yields the same form in `CHUNK_SIZE` pieces with a known length, so
+    the upload goes out with a Content-Length instead of a buffered copy.
+
+    The segment is hashed as it is streamed and the digest is sent as a form
+    field after the file part, so each upload reads the file exactly once.
+    `new_hasher` is called at the start of every pass, so the body can be sent
+    again (requests does on a 307/308 redirect) and still carry the right
+    digest. Pass a `digest` already computed for this file to skip hashing;
+    after a complete pass the digest that was sent is available as `.digest`,
+    and the time spent hashing as `.hash_seconds`.
+
+    File data is read into one reused buffer and yielded as memoryview slices
+    of it, so each chunk is only valid until the next one is requested; the
+    HTTP client sends every chunk before asking for another.
+
+    Exactly `size` bytes of file data are sent, matching the Content-Length;
+    if the file no longer has that size, iterating raises SegmentChangedError.
+    """
+    CHUNK_SIZE = 1048576
+
+    def __init__(self, filename, new_hasher, digest=None, file_field="segment", digest_field="sha1"):
+        self.filename = filename
+        self.new_hasher = new_hasher
+        self.known_digest = digest
+        self.digest = None
+        self.hash_seconds = 0.0
+        self.digest_length = new_hasher().digest_size * 2
+        self.digest_field = digest_field
+        self.boundary = uuid.uuid4().hex
+        self.head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{os.path.basename(filename)}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        self.size = os.path.getsize(filename)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _tail(self, digest):
+        return (
+            f'\r\n--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{self.digest_field}"\r\n\r\n{digest}\r\n'
+            f'--{self.boundary}--\r\n'
+        ).encode()
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self._tail("0" * self.digest_length))
+
+    def __iter__(self):
+        self.digest = None
+        self.hash_seconds = 0.0
+        hasher = self.new_hasher() if self.known_digest is None else None
+        buf = memoryview(bytearray(self.CHUNK_SIZE))
+        with open(self.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != self.size:
+                raise SegmentChangedError(f"{self.filename} is {size} bytes, expected {self.size}")
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            yield self.head
+            remaining = self.size
+            while remaining:
+                n = f.readinto(buf[:min(remaining, self.CHUNK_SIZE)])
+                if not n:
+                    raise SegmentChangedError(f"{self.filename} shrank by {remaining} bytes while it was sent")
+                remaining -= n
+                chunk = buf[:n]
+                if hasher:
+                    t0 = time.perf_counter()
+                    hasher.update(chunk)
+                    self.hash_seconds += time.perf_counter() - t0
+                yield chunk
+        digest = self.known_digest or hasher.hexdigest()
+        yield self._tail(digest)
+        self.digest = digest
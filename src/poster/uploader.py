@@ -0,0 +1,318 @@
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_delay, wait_random_exponential
+
+from segment_body import MultipartSegmentBody, SegmentChangedError
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """A failure reported by the API; logged when raised, counted by the sender."""
+    description = "upload exception"
+    metric = "upload.exception"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        logger.info(self.description)
+
+
+class TransientError(UploadError):
+    """The upload failed in a way that is worth retrying."""
+
+
+class PermanentError(UploadError):
+    """The upload failed in a way that retrying will not fix."""
+
+
+class ChecksumException(PermanentError):
+    description = "checksum exception"
+    metric = "checksum.exception"
+
+
+class FileStoreException(TransientError):
+    description = "file storage exception"
+    metric = "file.storage.exception"
+
+
+class DbUpdateException(TransientError):
+    description = "db update exception"
+    metric = "db.update.exception"
+
+
+# shared by every pool thread's sender; next() on a count is atomic under the GIL
+_sent_segments = itertools.count(1)
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class SegmentSender:
+    # (connect, read) seconds; read covers each wait on the socket, not the whole upload
+    TIMEOUT = (10, 120)
+
+    def __init__(self, api_url, camera, stats, digest_name='sha1'):
+        self.api_url = api_url
+        self.camera = camera
+        self.stats = stats
+        self.upload_url = f"{self.api_url}segment/upload/{self.camera}/"
+        self.send_metric = f"send#camera={camera}"
+        self.sent_metric = f"segment_sent#camera={camera}"
+        self.duration_metric = f"remote_segment_duration#camera={camera}"
+        self.digest_name = digest_name
+        # (filename, _file_identity, digest) of the last segment streamed in full,
+        # so a retried upload of the same, unchanged file does not hash it again
+        self._last_digest = None
+
+    @functools.cached_property
+    def api_session(self):
+        """The logged-in session, created on first use; delete it to log in again."""
+        t0 = time.time()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        token_url = f"{self.api_url}login/"
+        logger.debug("token url: %s", token_url)
+        r = session.get(token_url, timeout=self.TIMEOUT)
+        logger.debug(r.content)
+        token = r.json()["token"]
+        session.headers.update({'X-CSRFToken': token})
+        self.stats.gauge(f"session_init#camera={self.camera}", time.time() - t0)
+        return session
+
+    def _new_hasher(self):
+        if self.digest_name == 'blake3':
+            # hashes each chunk on all cores with the widest SIMD the CPU has
+            return blake3.blake3(max_threads=blake3.blake3.AUTO)
+        # hashlib's sha1 is OpenSSL's, which already uses SHA-NI where the CPU has it;
+        # usedforsecurity=False only keeps it available on FIPS-restricted builds
+        return hashlib.sha1(usedforsecurity=False)
+
+    def _post(self, filename):
+        key = (filename, _file_identity(filename))
+        digest = self._last_digest[2] if self._last_digest and self._last_digest[:2] == key else None
+        body = MultipartSegmentBody(filename, self._new_hasher, digest=digest, digest_field=self.digest_name)
+        try:
+            return self.api_session.post(
+                self.upload_url,
+                data=body,
+                headers={'Content-Type': body.content_type},
+                timeout=self.TIMEOUT
+            )
+        finally:
+            if body.digest:
+                logger.debug("checksum for %s: %s", filename, body.digest)
+                self._last_digest = (*key, body.digest)
+                if digest is None:
+                    self.stats.timing(f"segment_checksum#camera={self.camera}", body.hash_seconds * 1000)
+
+    def _counted(self, error):
+        self.stats.incr(f"{error.metric}#camera={self.camera}")
+        return error
+
+    def send(self, filename):
+        with self.stats.timer(self.send_metric):
+            self._send(filename)
+
+    @retry(stop=stop_after_delay(300), wait=wait_random_exponential(multiplier=1, max=60), reraise=True,
+           retry=retry_if_exception_type((TransientError, SegmentChangedError, requests.RequestException)),
+           before_sleep=lambda state: logger.warning("retrying after: %r", state.outcome.exception()))
+    def _send(self, filename):
+        logger.debug("sending %s to %s", filename, self.upload_url)
+        response = self._post(filename)
+        if response.status_code in (401, 403):
+            logger.info("session rejected with %s, logging in again", response.status_code)
+            session = self.__dict__.pop('api_session', None)
+            if session is not None:
+                session.close()
+            response = self._post(filename)
+        result = response.json()
+        # ideally, the response looks like:
+        # {"checksum": "pass", "duration": 3.999178, "start_time": 313.884178, "db_stored": true}
+        if not result["checksum"]:
+            raise self._counted(ChecksumException())
+        elif not result["duration"] > 0.0:
+            raise self._counted(FileStoreException())
+        elif not result["db_stored"]:
+            raise self._counted(DbUpdateException())
+        else:
+            logger.debug("sent %s to %s with response: %s", filename, self.upload_url, response.content)
+            sent = next(_sent_segments)
+            if sent % 8 == 0:
+                logger.info("sent %d segments since startup", sent)
+            with self.stats.pipeline() as pipe:
+                pipe.incr(self.sent_metric)
+                pipe.gauge(self.duration_metric, result["duration"])
+
+
+def _wait_until_stable(path, interval=0.3, required=2):
+    """Block until the file size is unchanged for `required` consecutive checks."""
+    prev, streak = -1, 0
+    while streak < required:
+        try:
+            cur = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        streak = streak + 1 if cur == prev and cur > 0 else 0
+        prev = cur
+        time.sleep(interval)
+
+
+class SegmentUploader:
+    """Uploads one settled segment per call and deletes it.
+
+    Each calling thread gets its own sender from `new_sender`, so no two
+    threads share a requests.Session. Segments the server rejects are moved
+    into `failed_dir`.
+    """
+    # seconds between the size checks that decide a segment has settled
+    STABLE_INTERVAL = 0.3
+
+    def __init__(self, new_sender, stats, camera, failed_dir):
+        self._new_sender = new_sender
+        self._local = threading.local()
+        self.stats = stats
+        self.camera = camera
+        self.failed_dir = failed_dir
+
+    def _sender(self):
+        if not hasattr(self._local, "sender"):
+            self._local.sender = self._new_sender()
+        return self._local.sender
+
+    def _set_aside(self, dest):
+        """Move a rejected segment into failed_dir so it isn't left among new ones."""
+        try:
+            os.makedirs(self.failed_dir, exist_ok=True)
+            os.replace(dest, os.path.join(self.failed_dir, os.path.basename(dest)))
+            logger.warning("moved rejected segment %s to %s", dest, self.failed_dir)
+        except OSError as e:
+            logger.error("could not move rejected segment %s to %s: %r", dest, self.failed_dir, e)
+
+    def _changed_since(self, dest, sent):
+        """Whether `dest` is no longer the file that was sent; such a file is left alone."""
+        try:
+            if _file_identity(dest) == sent:
+                return False
+        except FileNotFoundError:
+            pass
+        # replaced or rewritten mid-upload; the handler sends the new content
+        logger.info("%s changed during upload, keeping it", dest)
+        self.stats.incr(f"file.changed#camera={self.camera}")
+        return True
+
+    def __call__(self, dest):
+        try:
+            t0 = time.time()
+            _wait_until_stable(dest, interval=self.STABLE_INTERVAL)
+            t1 = time.time()
+            self.stats.gauge(f"wait_stable#camera={self.camera}", t1 - t0)
+            sent = _file_identity(dest)
+            self._sender().send(dest)
+            logger.info("timing send=%.2fs %s", time.time() - t1, dest)
+            if not self._changed_since(dest, sent):
+                os.unlink(dest)
+        except FileNotFoundError:
+            logger.warning("file disappeared before send: %s", dest)
+            self.stats.incr(f"file.disappeared#camera={self.camera}")
+        except PermanentError as e:
+            logger.error("server rejected %s, not retrying: %r", dest, e)
+            self.stats.incr(f"send.rejected#camera={self.camera}")
+            if not self._changed_since(dest, sent):
+                self._set_aside(dest)
+        except Exception as e:
+            logger.error("failed to send %s: %r", dest, e)
+            self.stats.incr(f"send.failed#camera={self.camera}")
+
+
+class NewSegmentHandler:
+    """Debounces segment events per path and runs `upload(path)` on a thread pool.
+
+    At most one upload per path is queued or running; an event that arrives
+    meanwhile makes the path go round again once that upload finishes.
+    """
+    # events for the same path closer together than this are coalesced into one upload
+    DEBOUNCE = 0.2
+
+    def __init__(self, upload, stats, camera, workers=4):
+        self._upload = upload
+        self.stats = stats
+        self.camera = camera
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        self._cond = threading.Condition()
+        # path -> monotonic deadline, and a heap of (deadline, path) that may hold stale entries
+        self._deadlines = {}
+        self._heap = []
+        self._pending = set()
+        # queued or uploading paths that saw another event, and so need sending again
+        self._dirty = set()
+        threading.Thread(target=self._run_deadlines, name="debounce", daemon=True).start()
+
+    def on_segment(self, dest):
+        with self._cond:
+            if dest in self._deadlines:
+                self.stats.incr(f"file_moved.coalesced#camera={self.camera}")
+            self._arm(dest)
+
+    def _arm(self, dest):
+        # called with self._cond held
+        deadline = time.monotonic() + self.DEBOUNCE
+        self._deadlines[dest] = deadline
+        heapq.heappush(self._heap, (deadline, dest))
+        self._cond.notify()
+
+    def _run_deadlines(self):
+        """Hand each path to the pool once its deadline passes with no newer event."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, dest = heapq.heappop(self._heap)
+                    # a later event for this path pushed a newer deadline
+                    if self._deadlines.get(dest) == deadline:
+                        del self._deadlines[dest]
+                        self._enqueue(dest)
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _enqueue(self, dest):
+        # called with self._cond held
+        if dest in self._pending:
+            logger.debug("%s is already queued or uploading, sending again after", dest)
+            self._dirty.add(dest)
+            return
+        self._pending.add(dest)
+        self.stats.gauge(f"queue_depth#camera={self.camera}", len(self._pending))
+        self._pool.submit(self._run_upload, dest)
+
+    def _run_upload(self, dest):
+        try:
+            self._upload(dest)
+        finally:
+            self._finished(dest)
+
+    def _finished(self, dest):
+        with self._cond:
+            self._pending.discard(dest)
+            if dest in self._dirty:
+                self._dirty.discard(dest)
+                # nothing to resend if the upload deleted it, or it was moved away
+                if os.path.exists(dest):
+                    self._arm(dest)
@@ -1,16 +1,14 @@
-from argparse import ArgumentParser, Namespace
-import hashlib
+from argparse import ArgumentParser
+import functools
 import logging
 import os
-import re
-import threading
-import time
+import sys
 
-import requests
-from retrying import retry
+from inotify_simple import INotify, flags
 from statsd import StatsClient
-from watchdog.events import FileSystemEvent, FileSystemEventHandler
-from watchdog.observers import Observer
+
+import uploader
+from uploader import NewSegmentHandler, SegmentSender, SegmentUploader
 
 requests_log = logging.getLogger("requests.packages.urllib3")
 requests_log.setLevel(logging.DEBUG)
@@ -21,14 +19,21 @@ parser.add_argument("input_path", help="input directory")
 parser.add_argument('--api', default=os.getenv("POSTER_API"), required=True)
 parser.add_argument('--camera', help="override the directory name with this camera name")
 parser.add_argument('--log-level', default="WARN")
+parser.add_argument('--recursive', action='store_true', help="also watch the existing subdirectories of the input directory")
+parser.add_argument('--workers', type=int, default=4, help="number of concurrent uploads")
+parser.add_argument('--digest', choices=['sha1', 'blake3'], default='sha1',
+                    help="segment checksum sent to the API; blake3 needs the blake3 package and a server that accepts it")
 parser.add_argument('--statsd-host', default='localhost')
 parser.add_argument('--statsd-port', default=8125)
 
 args = parser.parse_args()
 
+if args.digest == 'blake3' and uploader.blake3 is None:
+    parser.error("--digest blake3 requires the blake3 package")
+
 camera_name = args.camera if args.camera else os.path.basename(args.input_path.strip("/"))
 
-stats = StatsClient(host=args.statsd_host, port=args.statsd_port, prefix="poster")
+stats = StatsClient(host=args.statsd_host, port=args.statsd_port, prefix="poster", maxudpsize=1432)
 
 
 def _set_up_logging():
@@ -36,161 +41,73 @@ def _set_up_logging():
     level = logging.getLevelName(args.log_level.upper())
     formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
 
-    logger = logging.getLogger(__name__)
-    logger.setLevel(level)
-
     ch = logging.StreamHandler()
     ch.setLevel(level)
     ch.setFormatter(formatter)
 
-    logger.addHandler(ch)
+    for name in (__name__, uploader.__name__):
+        named = logging.getLogger(name)
+        named.setLevel(level)
+        named.addHandler(ch)
 
-    return logger
+    return logging.getLogger(__name__)
 
 logger = _set_up_logging()
 
-class ChecksumException(Exception):
-    pass
-
-def raise_checksum_exception():
-    logger.info(f"checksum exception")
-    stats.incr(f"checksum.exception#camera={camera_name}")
-    raise ChecksumException
-
-
-class FileStoreException(Exception):
-    pass
-
-def raise_file_store_exception():
-    logger.info(f"file storage exception")
-    stats.incr(f"file.storage.exception#camera={camera_name}")
-    raise FileStoreException
-
-class DbUpdateException(Exception):
-    pass
-
-def raise_db_update_exception():
-    logger.info(f"db update exception")
-    stats.incr(f"db.update.exception#camera={camera_name}")
-    raise DbUpdateException
-
-@stats.timer(f"segment_checksum#camera={camera_name}")
-def segment_checksum(filename):
-    logger.debug(f"calculating checksum for {filename}")
-    BUF_SIZE = 1048576
-    segment_sha1 = hashlib.sha1()
-    with open(filename, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            segment_sha1.update(data)
-    logger.debug(f"checksum for {filename}: {segment_sha1.hexdigest()}")
-    return segment_sha1.hexdigest()
-
-
-class SegmentSender:
-    def __init__(self, args: Namespace):
-        self.api_url = args.api
-        self.api_session = self._api_session()
-        self.camera = args.camera if args.camera else os.path.basename(args.input_path.strip("/"))
-        self.counter = 0
-
-    def _api_session(self):
-        session = requests.Session()
-        token_url = f"{self.api_url}login/"
-        logger.debug(f"token url: {token_url}")
-        r = session.get(token_url)
-        logger.debug(r.content)
-        token = r.json()["token"]
-        session.headers.update({'X-CSRFToken': token})
-        return session
-
-    @stats.timer(f"send#camera={camera_name}")
-    @retry(wait_random_min=1000, wait_random_max=2000, stop_max_attempt_number=5,
-           retry_on_exception=lambda e: not isinstance(e, FileNotFoundError) and (logger.warning(f"retrying after: {e!r}") or True))
-    def send(self, filename):
-        logger.debug(f"sending {filename}")
-        segment_sha1 = segment_checksum(filename)
-        api_url = f"{self.api_url}segment/upload/{self.camera}/"
-        logger.debug(f"sending {filename} to {api_url}")
-        response = self.api_session.post(
-            api_url,
-            files={'segment': open(filename, 'rb')},
-            data={'sha1': segment_sha1}
-        )
-        result = response.json()
-        # ideally, the response looks like:
-        # {"checksum": "pass", "duration": 3.999178, "start_time": 313.884178, "db_stored": true}
-        if not result["checksum"]:
-            raise_checksum_exception()
-        elif not result["duration"] > 0.0:
-            raise_file_store_exception()
-        elif not result["db_stored"]:
-            raise_db_update_exception()
-        else:
-            logger.debug(f"sent {filename} to {api_url} with response: {response.content}")
-            self.counter += 1
-            if self.counter % 8 == 0:
-                logger.info(f"sent {self.counter} segments since startup")
-            result = response.json()
-            stats.incr(f"segment_sent#camera={camera_name}")
-            stats.gauge(f"remote_segment_duration#camera={camera_name}", result["duration"])
-
-def _wait_until_stable(path, interval=0.3, required=2):
-    """Block until the file size is unchanged for `required` consecutive checks."""
-    prev, streak = -1, 0
-    while streak < required:
-        try:
-            cur = os.path.getsize(path)
-        except FileNotFoundError:
-            return
-        streak = streak + 1 if cur == prev and cur > 0 else 0
-        prev = cur
-        time.sleep(interval)
-
-
-class NewSegmentHandler(FileSystemEventHandler):
-    _upload_sem = threading.Semaphore(4)
-
-    def on_any_event(self, event):
-        logger.debug(f"file {event.src_path} {event.event_type}")
-
-    def on_moved(self, event: FileSystemEvent) -> None:
-        dest = event.dest_path
-        if not re.search(r'\.ts$', dest):
-            return
-        stats.incr(f"file_moved#camera={camera_name}")
-        def _worker():
-            t0 = time.time()
-            _wait_until_stable(dest)
-            t1 = time.time()
-            stats.gauge(f"wait_stable#camera={camera_name}", t1 - t0)
-            with self._upload_sem:
-                t2 = time.time()
-                stats.gauge(f"sem_wait#camera={camera_name}", t2 - t1)
-                sender = SegmentSender(args)
-                t3 = time.time()
-                stats.gauge(f"session_init#camera={camera_name}", t3 - t2)
-                try:
-                    sender.send(dest)
-                    logger.info(f"timing send={time.time()-t3:.2f}s {dest}")
-                    os.unlink(dest)
-                except FileNotFoundError:
-                    logger.warning(f"file disappeared before send: {dest}")
-                    stats.incr(f"file.disappeared#camera={camera_name}")
-                except Exception as e:
-                    logger.error(f"failed to send {dest}: {e!r}")
-                    stats.incr(f"send.failed#camera={camera_name}")
-        threading.Thread(target=_worker, daemon=True).start()
-
-event_handler = NewSegmentHandler()
-observer = Observer()
-observer.schedule(event_handler, args.input_path, recursive=True)
-observer.start()
-try:
+# file name suffixes that are uploaded as segments
+SEGMENT_SUFFIXES = ('.ts',)
+
+# segments the server rejects are moved into this directory under the input
+# directory; it is never watched, so moving them there can't trigger an upload
+FAILED_DIR = os.path.join(args.input_path, "failed")
+
+
+@functools.lru_cache(maxsize=1024)
+def _is_segment(path):
+    return path.endswith(SEGMENT_SUFFIXES)
+
+
+# a segment is complete once it is renamed into place or its writer closes it
+SEGMENT_EVENTS = flags.MOVED_TO | flags.CLOSE_WRITE
+
+
+def _add_watches(inotify, root, recursive):
+    """Watch `root`, and its existing subdirectories if `recursive`; returns {wd: directory}.
+
+    FAILED_DIR is never watched.
+    """
+    dirs = [root]
+    if recursive:
+        for parent, subdirs, _ in os.walk(root):
+            subdirs[:] = [name for name in subdirs if os.path.normpath(os.path.join(parent, name)) != os.path.normpath(FAILED_DIR)]
+            dirs += [os.path.join(parent, name) for name in subdirs]
+    return {inotify.add_watch(d, SEGMENT_EVENTS): d for d in dirs}
+
+
+upload = SegmentUploader(
+    lambda: SegmentSender(args.api, camera_name, stats, digest_name=args.digest),
+    stats, camera_name, FAILED_DIR,
+)
+event_handler = NewSegmentHandler(upload, stats, camera_name, workers=args.workers)
+with INotify() as inotify:
+    watches = _add_watches(inotify, args.input_path, args.recursive)
     while True:
-        time.sleep(1)
-finally:
-    observer.stop()
-    observer.join()
+        for event in inotify.read():
+            logger.debug("file %s mask=%#x", event.name, event.mask)
+            if event.mask & flags.Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, events were dropped")
+                stats.incr(f"inotify.overflow#camera={camera_name}")
+                continue
+            if event.mask & flags.IGNORED:
+                logger.warning("stopped watching %s", watches.pop(event.wd, None))
+                if not watches:
+                    logger.error("no directories left to watch under %s, exiting", args.input_path)
+                    sys.exit(1)
+                continue
+            if event.mask & flags.ISDIR or not _is_segment(event.name) or event.wd not in watches:
+                continue
+            if event.mask & flags.MOVED_TO:
+                stats.incr(f"file_moved#camera={camera_name}")
+            else:
+                stats.incr(f"file_closed#camera={camera_name}")
+            event_handler.on_segment(os.path.join(watches[event.wd], event.name))
@@ -0,0 +1,95 @@
+from email.parser import BytesParser
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "poster"))
+
+from segment_body import MultipartSegmentBody, SegmentChangedError  # noqa: E402
+
+
+def _encode(body):
+    # chunks are views of a reused buffer, so copy each one out before the next
+    data = bytearray()
+    for chunk in body:
+        data += chunk
+    return bytes(data)
+
+
+def _parse(body, data):
+    message = BytesParser().parsebytes(f"Content-Type: {body.content_type}\r\n\r\n".encode() + data)
+    return {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+
+
+class MultipartSegmentBodyTest(unittest.TestCase):
+    def setUp(self):
+        # not a multiple of CHUNK_SIZE, so the last read is a partial chunk
+        self.content = os.urandom(MultipartSegmentBody.CHUNK_SIZE * 2 + 12345)
+        fd, self.filename = tempfile.mkstemp(suffix=".ts")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.content)
+        self.addCleanup(os.unlink, self.filename)
+
+    def test_round_trip(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1)
+        data = _encode(body)
+        self.assertEqual(len(data), len(body))
+        parts = _parse(body, data)
+        self.assertEqual(parts["segment"].get_filename(), os.path.basename(self.filename))
+        self.assertEqual(parts["segment"].get_payload(decode=True), self.content)
+        self.assertEqual(parts["sha1"].get_payload(), hashlib.sha1(self.content).hexdigest())
+        self.assertEqual(body.digest, hashlib.sha1(self.content).hexdigest())
+
+    def test_second_pass_has_the_same_digest(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1)
+        first = _encode(body)
+        second = _encode(body)
+        self.assertEqual(_parse(body, second)["sha1"].get_payload(), hashlib.sha1(self.content).hexdigest())
+        self.assertEqual(first, second)
+
+    def test_known_digest_is_sent_as_is(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1, digest="0" * 40, digest_field="blake3")
+        data = _encode(body)
+        self.assertEqual(len(data), len(body))
+        self.assertEqual(_parse(body, data)["blake3"].get_payload(), "0" * 40)
+
+    def test_digest_is_unset_until_a_pass_completes(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1)
+        chunks = iter(body)
+        next(chunks)
+        next(chunks)
+        self.assertIsNone(body.digest)
+
+    def _rewrite(self, content):
+        with open(self.filename, "wb") as f:
+            f.write(content)
+
+    def test_grown_file_is_not_sent(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1)
+        self._rewrite(self.content + b"more")
+        with self.assertRaises(SegmentChangedError):
+            _encode(body)
+        self.assertIsNone(body.digest)
+
+    def test_shrunk_file_is_not_sent(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1)
+        self._rewrite(self.content[:100])
+        with self.assertRaises(SegmentChangedError):
+            _encode(body)
+
+    def test_file_growing_mid_pass_is_cut_at_the_declared_size(self):
+        body = MultipartSegmentBody(self.filename, hashlib.sha1)
+        data = bytearray()
+        for i, chunk in enumerate(body):
+            data += chunk
+            if i == 1:
+                with open(self.filename, "ab") as f:
+                    f.write(b"appended after the size check")
+        self.assertEqual(len(data), len(body))
+        self.assertEqual(_parse(body, bytes(data))["segment"].get_payload(decode=True), self.content)
+
+
+if __name__ == "__main__":
+    unittest.main()
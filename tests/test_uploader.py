@@ -0,0 +1,199 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "poster"))
+
+from uploader import ChecksumException, NewSegmentHandler, SegmentSender, SegmentUploader  # noqa: E402
+
+
+class FakeStats:
+    def __init__(self):
+        self.counts = {}
+
+    def incr(self, stat, count=1):
+        self.counts[stat] = self.counts.get(stat, 0) + count
+
+    def gauge(self, stat, value):
+        pass
+
+    def timing(self, stat, ms):
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, stat):
+        yield
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        yield self
+
+
+def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.stats = FakeStats()
+
+    def _write(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+
+class NewSegmentHandlerTest(TempDirTestCase):
+    def _handler(self, upload):
+        handler = NewSegmentHandler(upload, self.stats, "cam", workers=2)
+        handler.DEBOUNCE = 0.05
+        return handler
+
+    def test_events_in_a_burst_are_coalesced_into_one_upload(self):
+        path = self._write("a.ts", b"a")
+        calls = []
+        handler = self._handler(calls.append)
+        for _ in range(3):
+            handler.on_segment(path)
+        _wait_for(lambda: calls)
+        time.sleep(0.2)
+        self.assertEqual(calls, [path])
+        self.assertEqual(self.stats.counts["file_moved.coalesced#camera=cam"], 2)
+
+    def test_event_during_upload_sends_the_path_again_afterwards(self):
+        path = self._write("a.ts", b"a")
+        calls, release = [], threading.Event()
+
+        def upload(dest):
+            calls.append(dest)
+            release.wait(2)
+
+        handler = self._handler(upload)
+        handler.on_segment(path)
+        _wait_for(lambda: calls)
+        handler.on_segment(path)
+        time.sleep(0.2)
+        self.assertEqual(len(calls), 1, "a path must not be uploaded twice at once")
+        release.set()
+        _wait_for(lambda: len(calls) == 2)
+
+    def test_no_second_upload_once_the_file_is_gone(self):
+        path = self._write("a.ts", b"a")
+        calls, release = [], threading.Event()
+
+        def upload(dest):
+            calls.append(dest)
+            release.wait(2)
+            os.unlink(dest)
+
+        handler = self._handler(upload)
+        handler.on_segment(path)
+        _wait_for(lambda: calls)
+        handler.on_segment(path)
+        time.sleep(0.2)
+        release.set()
+        time.sleep(0.3)
+        self.assertEqual(calls, [path])
+
+
+class FakeSender:
+    def __init__(self, during_send=None, error=None):
+        self.sent = []
+        self.during_send = during_send
+        self.error = error
+
+    def send(self, filename):
+        self.sent.append(filename)
+        if self.during_send:
+            self.during_send(filename)
+        if self.error:
+            raise self.error
+
+
+class SegmentUploaderTest(TempDirTestCase):
+    def _uploader(self, sender):
+        upload = SegmentUploader(lambda: sender, self.stats, "cam", os.path.join(self.dir, "failed"))
+        upload.STABLE_INTERVAL = 0.01
+        return upload
+
+    def _replace(self, path):
+        os.replace(self._write("next.tmp", b"newer segment"), path)
+
+    def test_sent_segment_is_deleted(self):
+        path = self._write("a.ts", b"a")
+        sender = FakeSender()
+        self._uploader(sender)(path)
+        self.assertEqual(sender.sent, [path])
+        self.assertFalse(os.path.exists(path))
+
+    def test_segment_replaced_during_upload_is_kept(self):
+        path = self._write("a.ts", b"a")
+        self._uploader(FakeSender(during_send=self._replace))(path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"newer segment")
+        self.assertEqual(self.stats.counts["file.changed#camera=cam"], 1)
+
+    def test_rejected_segment_is_moved_to_failed_dir(self):
+        path = self._write("a.ts", b"a")
+        self._uploader(FakeSender(error=ChecksumException()))(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "failed", "a.ts")))
+
+    def test_segment_replaced_during_a_rejected_upload_is_kept(self):
+        path = self._write("a.ts", b"a")
+        self._uploader(FakeSender(during_send=self._replace, error=ChecksumException()))(path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"newer segment")
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "failed", "a.ts")))
+
+
+class FakeSession:
+    """Sends nothing; records the digest field each posted body carried."""
+
+    def __init__(self):
+        self.digests = []
+
+    def post(self, url, data, headers, timeout):
+        for _ in data:
+            pass
+        self.digests.append(data.digest)
+
+
+class SegmentSenderDigestTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sender = SegmentSender("http://api/", "cam", self.stats)
+        self.session = self.sender.__dict__["api_session"] = FakeSession()
+
+    def test_unchanged_file_reuses_its_digest(self):
+        path = self._write("a.ts", b"first segment")
+        self.sender._post(path)
+        self.sender._post(path)
+        self.assertEqual(self.session.digests, [hashlib.sha1(b"first segment").hexdigest()] * 2)
+
+    def test_file_replaced_with_same_size_and_mtime_is_hashed_again(self):
+        path = self._write("a.ts", b"first segment")
+        self.sender._post(path)
+        st = os.stat(path)
+        replacement = self._write("b.tmp", b"other segment")
+        os.utime(replacement, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(replacement, path)
+        self.sender._post(path)
+        self.assertEqual(self.session.digests[-1], hashlib.sha1(b"other segment").hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()